@@ -8,6 +8,11 @@ def use_api_call() -> bool:
     return True
 
 
+def max_items_per_request() -> int:
+    """Maximum number of items sent to the Exchange server in a single bulk request"""
+    return 100
+
+
 def is_async_online_lecture(subject: str, room: str) -> bool:
     """Check if an event is an asynchronous online lecutre"""
     return "Geleitetes Selbststudium" in subject and room == "Online"
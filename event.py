@@ -9,8 +9,11 @@ from exchangelib import (
 )
 from exchangelib.items import SEND_TO_NONE
 
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import functools
 import keyring
+import keyring.errors
+import pytz
 import os
 import logging
 from config import get_travel_time, at_different_location, is_async_online_lecture
@@ -20,6 +23,26 @@ MS_TIMEZONE_TO_IANA_MAP["(UTC+01:00) Amsterdam, Berlin, Bern, Rom, Stockholm, Wi
     "Europe/Vienna"
 )
 
+# Adjust as needed for MCI location
+_LOCAL_TZ = pytz.timezone("Europe/Vienna")
+
+_DEFAULT_ORGANIZER = "MCI-DESIGNER-TERMIN"
+
+# Always add a marker category to identify events created by this script
+_MARKER_CATEGORY = "MCI-DESIGNER-TERMIN"
+
+# Fields read from Exchange calendar items, fetching fewer fields keeps the EWS responses small
+CALENDAR_ITEM_FIELDS = ("subject", "start", "end", "location", "organizer")
+
+
+@functools.lru_cache(maxsize=None)
+def _get_exchange_password(username: str | None) -> str | None:
+    """Look up the Exchange password only once, the system keyring can be slow to query"""
+    try:
+        return keyring.get_password("lecture_calendar_fixer_exchange", username)
+    except keyring.errors.KeyringError as e:
+        raise ValueError(f"Could not access the system keyring: {e}") from e
+
 
 class ExchangeAccountManager:
     def __init__(self):
@@ -28,9 +51,7 @@ class ExchangeAccountManager:
         self.username = os.getenv(
             "EXCHANGE_USERNAME", self.email
         )  # fallback to email if not set
-        self.password = keyring.get_password(
-            "lecture_calendar_fixer_exchange", self.username
-        )
+        self.password = _get_exchange_password(self.username)
         self.server = os.getenv(
             "EXCHANGE_SERVER"
         )  # optional, auto-discovery will be used if not set
@@ -47,6 +68,7 @@ class ExchangeAccountManager:
             )
 
         self._account = None
+        self._items_cache: dict[str | None, list[CalendarItem]] = {}
 
     def get_account(self) -> Account:
         """Get Exchange account instance"""
@@ -77,28 +99,38 @@ class ExchangeAccountManager:
 
     def get_calendar_items(self, organizer_filter=None):
         """Get calendar items, optionally filtered by organizer"""
+        if organizer_filter in self._items_cache:
+            return self._items_cache[organizer_filter]
+
         account = self.get_account()
-        # Get all calendar items
         calendar_folder = account.calendar
-        items = list(calendar_folder.all())
 
         if organizer_filter:
-            filtered_items = []
-            for item in items:
-                # Filter by the marker category that we add to all our events
-                if hasattr(item, 'categories') and item.categories:
-                    if any(organizer_filter in str(cat) for cat in item.categories):
-                        filtered_items.append(item)
-            return filtered_items
+            # Filter server-side by the marker category that we add to all our events
+            query = calendar_folder.filter(categories__contains=[organizer_filter])
+            items = list(query.only(*CALENDAR_ITEM_FIELDS, "categories", "reminder_is_set"))
+        else:
+            items = list(calendar_folder.all().only(*CALENDAR_ITEM_FIELDS))
 
+        self._items_cache[organizer_filter] = items
         return items
 
+    def invalidate(self):
+        """Drop all cached calendar items, e.g. after new items have been saved"""
+        self._items_cache.clear()
+
+    def forget_calendar_item(self, item: CalendarItem):
+        """Remove a single deleted item from the cached calendar items"""
+        for items in self._items_cache.values():
+            if item in items:
+                items.remove(item)
+
 
 class EventWrapper:
     def __init__(
         self,
         subject: str,
-        start: str,
+        start: str | None,
         duration: int,
         location: str,
         organizer: str | None = None,
@@ -107,16 +139,21 @@ class EventWrapper:
         kind: str = "Lehrveranstaltung",
     ) -> None:
         self.subject = subject
-        self.start = start
+        self._start = start
         self.duration = duration
         self.location = location
         self.start_dt = start_dt
-        self.organizer = (
-            organizer if organizer else EventWrapper.get_default_organizer()
-        )
+        self.organizer = organizer if organizer else _DEFAULT_ORGANIZER
         self.is_online = is_online
         self.kind = kind
 
+    @property
+    def start(self) -> str | None:
+        """Start as formatted string, only built from start_dt when it is accessed"""
+        if self._start is None and self.start_dt:
+            return self.start_dt.strftime("%Y-%m-%d %H:%M")
+        return self._start
+
     @classmethod
     def from_ical_event(cls, event: ICalEvent):
         subject = event["summary"]
@@ -128,7 +165,7 @@ class EventWrapper:
         location = location if location else "-"
 
         organizer = event.get("UID")
-        organizer = str(organizer) if organizer else cls.get_default_organizer()
+        organizer = str(organizer) if organizer else _DEFAULT_ORGANIZER
 
         return cls(
             subject, start, dur, location, organizer=organizer, start_dt=start_dt
@@ -141,7 +178,6 @@ class EventWrapper:
         start_dt = datetime.fromisoformat(api_dict["start"])
         end_dt = datetime.fromisoformat(api_dict["end"])
         dur = int((end_dt - start_dt).total_seconds() / 60)
-        start = start_dt.strftime("%Y-%m-%d %H:%M")
 
         kind = api_dict["art"]
         is_online = api_dict["online"]
@@ -154,13 +190,13 @@ class EventWrapper:
 
         id = api_dict["id"]
         if id[0].isnumeric():
-            organizer = f"{cls.get_default_organizer()}-{id}"
+            organizer = f"{_DEFAULT_ORGANIZER}-{id}"
         else:
-            organizer = cls.get_default_organizer()
+            organizer = _DEFAULT_ORGANIZER
 
         return cls(
             subject,
-            start,
+            None,
             dur,
             location,
             organizer=organizer,
@@ -175,19 +211,16 @@ class EventWrapper:
         start_dt = event.start.astimezone()
         end_dt = event.end.astimezone()
         duration = int((end_dt - start_dt).total_seconds() / 60)
-        start_str = start_dt.strftime("%Y-%m-%d %H:%M")
         location = event.location if event.location else "-"
         organizer = (
-            event.organizer.email_address
-            if event.organizer
-            else cls.get_default_organizer()
+            event.organizer.email_address if event.organizer else _DEFAULT_ORGANIZER
         )
-        return cls(event.subject, start_str, duration, location, organizer, start_dt)
-
-    def to_outlook_event(self, account: Account):
-        from datetime import timedelta
-        import pytz
+        return cls(event.subject, None, duration, location, organizer, start_dt)
 
+    def build_calendar_item(
+        self, account: Account, now: datetime | None = None
+    ) -> CalendarItem:
+        """Create the calendar item for this event without saving it"""
         if not self.start_dt:
             raise ValueError("start_dt must be set for exchangelib integration")
 
@@ -196,12 +229,8 @@ class EventWrapper:
 
         # Ensure timezone awareness - use local timezone if none is set
         if self.start_dt.tzinfo is None:
-            # Assume local timezone if not set
-            local_tz = pytz.timezone(
-                "Europe/Vienna"
-            )  # Adjust as needed for MCI location
-            start_dt_tz = local_tz.localize(self.start_dt)
-            end_dt_tz = local_tz.localize(end_dt)
+            start_dt_tz = _LOCAL_TZ.localize(self.start_dt)
+            end_dt_tz = _LOCAL_TZ.localize(end_dt)
         else:
             start_dt_tz = self.start_dt
             end_dt_tz = end_dt
@@ -210,22 +239,15 @@ class EventWrapper:
         start_ews = EWSDateTime.from_datetime(start_dt_tz)
         end_ews = EWSDateTime.from_datetime(end_dt_tz)
 
-        # by default handle events as if they were past events
-        is_past = True
-        if self.start_dt:
-            is_past = self.start_dt < datetime.now(
-                self.start_dt.tzinfo if self.start_dt.tzinfo else None
-            )
+        # when building many items the caller passes the current time once for all of them
+        now_utc = now if now else datetime.now(timezone.utc)
+        is_past = start_dt_tz.timestamp() < now_utc.timestamp()
 
         # default values for category and reminder time --> ToDo: move to config.py .env
         category = "Vorlesung"
         reminder_on = True
         reminder_time = 15
         legacy_free_busy_status = "Busy"
-        
-        # Always add a marker category to identify events created by this script
-        marker_category = "MCI-DESIGNER-TERMIN"
-        categories = [category, marker_category]
 
         if self.location != "-":
             room, mci_location, *_ = self.location.split(" / ")
@@ -235,82 +257,81 @@ class EventWrapper:
                 reminder_on = False
             elif at_different_location(mci_location):
                 category = "Vorlesung-Anderer-Standort"
-                categories = [category, marker_category]
                 reminder_time += get_travel_time(mci_location)
             elif self.kind not in ["Lehrveranstaltung", "Prüfung", "Sonstiges"]:
                 legacy_free_busy_status = "Free"
 
+        item_kwargs = dict(
+            account=account,
+            folder=account.calendar,
+            subject=self.subject,
+            start=start_ews,
+            end=end_ews,
+            location=self.location,
+            legacy_free_busy_status=legacy_free_busy_status,
+            categories=[category, _MARKER_CATEGORY],
+            reminder_is_set=(not is_past) and reminder_on,
+        )
+
         # Create calendar item with reminder settings
-        if (not is_past) and reminder_on:
-            item = CalendarItem(
-                account=account,
-                folder=account.calendar,
-                subject=self.subject,
-                start=start_ews,
-                end=end_ews,
-                location=self.location,
-                legacy_free_busy_status=legacy_free_busy_status,
-                categories=categories,
-                reminder_is_set=True,
-                reminder_minutes_before_start=reminder_time,
-            )
-        else:
-            item = CalendarItem(
-                account=account,
-                folder=account.calendar,
-                subject=self.subject,
-                start=start_ews,
-                end=end_ews,
-                location=self.location,
-                legacy_free_busy_status=legacy_free_busy_status,
-                categories=categories,
-                reminder_is_set=False,
-            )
+        if item_kwargs["reminder_is_set"]:
+            item_kwargs["reminder_minutes_before_start"] = reminder_time
+
+        item = CalendarItem(**item_kwargs)
+
+        return item
 
-        # Save the item
+    def to_outlook_event(
+        self, account: Account, now: datetime | None = None
+    ) -> CalendarItem:
+        item = self.build_calendar_item(account, now)
         item.save(send_meeting_invitations=SEND_TO_NONE)
 
         return item
 
     @staticmethod
     def get_default_organizer() -> str:
-        return "MCI-DESIGNER-TERMIN"
+        return _DEFAULT_ORGANIZER
 
-    def __eq__(self, __value: object) -> bool:
-        if not isinstance(__value, EventWrapper):
-            return False
+    def _start_utc(self) -> datetime | None:
+        """Start as UTC-aware datetime, naive start times are assumed to be local"""
+        if not self.start_dt:
+            return None
+        start_dt = self.start_dt
+        if start_dt.tzinfo is None:
+            start_dt = _LOCAL_TZ.localize(start_dt)
+        # go through the timestamp, EWSDateTime.astimezone only accepts an EWSTimeZone
+        return datetime.fromtimestamp(start_dt.timestamp(), tz=timezone.utc)
 
-        same_subject = self.subject == __value.subject
+    def _start_equals(self, other: "EventWrapper") -> bool:
+        self_start = self._start_utc()
+        other_start = other._start_utc()
 
-        # If the EventWrapper is coming from an icalendar event then the start is a string, but it also always has the start_dt attribute
-        # If the EventWrapper is coming from an exchangelib event then the start is a datetime object
-        # ToDo: Remove this distinction between the two ways a EventWrapper can be created
-        self_start = self.start
-        if isinstance(self_start, str) and self.start_dt:
-            self_start = self.start_dt
+        if self_start and other_start:
+            return self_start == other_start
+        if self.start and other.start:
+            # fallback to string comparison if start_dt is not set
+            return self.start == other.start
+        return False
 
-        other_start = __value.start
-        if isinstance(other_start, str) and __value.start_dt:
-            other_start = __value.start_dt
+    def __eq__(self, __value: object) -> bool:
+        if not isinstance(__value, EventWrapper):
+            return False
 
-        same_start = False
-        if self_start and other_start:
-            if hasattr(self_start, "ctime") and hasattr(other_start, "ctime"):
-                same_start = self_start.ctime() == other_start.ctime()
-            else:
-                # fallback to string comparison if not datetime objects
-                same_start = str(self_start) == str(other_start)
-
-        same_duration = self.duration == __value.duration
-        same_location = self.location == __value.location
-        same_organizer = self.organizer == __value.organizer
-        return (
-            same_subject
-            and same_start
-            and same_duration
-            and same_location
-            and same_organizer
-        )
+        # compare the cheap fields first, this only saves the start time normalization
+        # and is not needed for correctness, _start_equals handles every start_dt type
+        if self.subject != __value.subject:
+            return False
+        if self.duration != __value.duration:
+            return False
+        # ToDo: the organizer of an Outlook item is the mailbox address, while imported events use
+        # "MCI-DESIGNER-TERMIN-<id>" or the iCal UID, so matched events usually compare unequal and
+        # are deleted and recreated on every run
+        if self.organizer != __value.organizer:
+            return False
+        if self.location != __value.location:
+            return False
+        return self._start_equals(__value)
 
     def __str__(self) -> str:
         return f"Subject: {self.subject}\n\tStart: {self.start}\n\tDuration: {self.duration}\n\tLocation: {self.location}\n\tOrganizer: {self.organizer}\n\tStart_dt: {self.start_dt}"
@@ -1,73 +1,217 @@
 import logging
 import datetime
 import os
+import random
+import time
 from pathlib import Path
 
 from dotenv import load_dotenv
 
 import icalendar
 import requests
+from exchangelib import CalendarItem
+from exchangelib.errors import ErrorServerBusy
+from exchangelib.items import SEND_TO_NONE
 
 from event import EventWrapper, ExchangeAccountManager
 from api_call import load_from_mymci_api
 import config
 
+# reused for all HTTP requests so that the TCP connection is kept alive
+http_session = requests.Session()
+
+
+def fetch_webcal(url: str) -> bytes:
+    """Download the raw iCal body, the bytes are passed to the parser without decoding them first"""
+    # icalendar needs the full body, so there is nothing to gain from streaming the download
+    response = http_session.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
 
 def delete_all_existing_lecture_events(exchange_manager):
     calendar_items = exchange_manager.get_calendar_items(
         EventWrapper.get_default_organizer()
     )
 
-    logging.info(f"Found {len(calendar_items)} calendar items")
-
-    should_retry = 1
-    tries = 0
-    while should_retry > 0 and tries < 5:
-        tries += 1
-        should_retry -= 1
+    logging.info("Found %d calendar items", len(calendar_items))
 
+    # only wrap the items if they are actually logged
+    if logging.getLogger().isEnabledFor(logging.INFO):
         for item in calendar_items:
             logging.info(
-                f"\nTrying to delete calendar item:\n\t{EventWrapper.from_outlook_event(item)}"
+                "\nTrying to delete calendar item:\n\t%s",
+                EventWrapper.from_outlook_event(item),
             )
-            try:
-                item.delete()
-            except Exception as e:
-                logging.warning(
-                    f"Could not delete calendar item (Exception {e}), adding retry"
-                )
-                should_retry += 1
 
+    # pass a copy, deleted items are removed from the cached list
+    delete_calendar_items(list(calendar_items), exchange_manager)
 
-def add_lecture_events_to_outlook(webcalendar, exchange_manager):
-    all_events = [
-        subcomp for subcomp in webcalendar.subcomponents if subcomp.name == "VEVENT"
-    ]
-    lecture_events = [
-        event for event in all_events if "Abgabetermin" not in event["summary"]
+
+def add_lecture_events_to_outlook(webcalendar, exchange_manager) -> int:
+    wrappers = [
+        EventWrapper.from_ical_event(subcomp)
+        for subcomp in webcalendar.subcomponents
+        if subcomp.name == "VEVENT" and "Abgabetermin" not in subcomp["summary"]
     ]
 
-    logging.info(f"Found {len(lecture_events)} lecture events")
+    logging.info("Found %d lecture events", len(wrappers))
+
+    for wrapper in wrappers:
+        logging.info("\nAdding event:\n\t%s", wrapper)
+
+    return save_events_to_outlook(wrappers, exchange_manager)
+
+
+def save_events_to_outlook(wrappers: list[EventWrapper], exchange_manager) -> int:
+    """Save the events to Outlook, returns the number of events that could not be created"""
+    if not wrappers:
+        return 0
 
     account = exchange_manager.get_account()
-    for event in lecture_events:
-        wrapper = EventWrapper.from_ical_event(event)
-        logging.info(f"\nAdding event:\n\t{wrapper}")
-        wrapper.to_outlook_event(account)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    items = [wrapper.build_calendar_item(account, now) for wrapper in wrappers]
 
+    chunk_size = config.max_items_per_request()
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
 
-def try_deleting_calendar_item(item) -> bool:
-    attempts = 0
-    while attempts < 5:
+    # a semester fits into a few bulk requests, so the chunks are simply sent one after another
+    failed_items = []
+    try:
+        for chunk in chunks:
+            failed_items.extend(create_calendar_items(chunk, account))
+    finally:
+        # some chunks may have been created even if another one failed
+        exchange_manager.invalidate()
+
+    # only items the server explicitly rejected are retried, so nothing is created twice
+    failed_count = 0
+    for item in failed_items:
         try:
-            item.delete()
-            return True
+            _retry(lambda: item.save(send_meeting_invitations=SEND_TO_NONE))
         except Exception as e:
+            logging.error(
+                "Could not create calendar item %s at %s (Exception %s)",
+                item.subject,
+                item.start,
+                e,
+            )
+            failed_count += 1
+
+    return failed_count
+
+
+def create_calendar_items(items: list, account) -> list:
+    """Create the items with a single request, returns the items the server rejected"""
+    # errors of the whole request are raised, the server may already have created some items
+    results = _retry(
+        lambda: account.bulk_create(
+            folder=account.calendar,
+            items=items,
+            send_meeting_invitations=SEND_TO_NONE,
+        )
+    )
+
+    # bulk_create returns the created item id or the exception for every single item
+    failed_items = []
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
             logging.warning(
-                f"Could not delete calendar item (Exception {e}), retrying..."
+                "Could not create calendar item %s (Exception %s), retrying",
+                item.subject,
+                result,
             )
-        attempts += 1
-    return False
+            failed_items.append(item)
+    return failed_items
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Check if the Exchange server rejected a request because it is busy"""
+    # exchangelib reports throttling (HTTP 429/503) and dropped connections as ErrorServerBusy,
+    # but also a plain HTTP 401 which is usually caused by wrong credentials
+    return isinstance(error, ErrorServerBusy) and error.args[:1] != (
+        "Caused by HTTP 401 response",
+    )
+
+
+def _retry(fn, *, max_attempts=4, base=0.5, max_wait=8):
+    """Call fn and retry with exponential backoff as long as the server is throttling"""
+    for attempt in range(max_attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not is_throttling_error(e):
+                raise
+
+            # give up if the server asks to back off longer than we are willing to block
+            back_off = getattr(e, "back_off", None) or 0
+            if back_off > max_wait:
+                logging.warning(
+                    "Exchange server asked to back off for %ss, giving up", back_off
+                )
+                raise
+
+            wait = min(max_wait, base * 2**attempt) + random.random() * 0.1
+            # respect the back off suggested by the server if it is longer
+            wait = max(back_off, wait)
+            logging.warning(
+                "Exchange server is busy (Exception %s), retrying in %.2fs...", e, wait
+            )
+            time.sleep(wait)
+
+
+def try_deleting_calendar_item(item, exchange_manager) -> bool:
+    try:
+        _retry(item.delete)
+    except Exception as e:
+        logging.warning("Could not delete calendar item (Exception %s)", e)
+        return False
+
+    exchange_manager.forget_calendar_item(item)
+    return True
+
+
+def delete_calendar_items(calendar_items: list, exchange_manager):
+    account = exchange_manager.get_account()
+    chunk_size = config.max_items_per_request()
+
+    failed_items = []
+    for i in range(0, len(calendar_items), chunk_size):
+        chunk = calendar_items[i : i + chunk_size]
+        ids = [(item.id, item.changekey) for item in chunk]
+        try:
+            results = _retry(
+                lambda: account.bulk_delete(
+                    ids=ids, send_meeting_cancellations=SEND_TO_NONE
+                )
+            )
+        except Exception as e:
+            if is_throttling_error(e):
+                # don't flood a busy server with single requests, the next run deletes them
+                logging.warning(
+                    "Could not delete %d calendar items (Exception %s), leaving them for the next run",
+                    len(chunk),
+                    e,
+                )
+                continue
+
+            logging.warning(
+                "Could not delete %d calendar items (Exception %s), retrying one by one",
+                len(chunk),
+                e,
+            )
+            failed_items.extend(chunk)
+            continue
+
+        # bulk_delete returns True or the exception for every single item
+        for item, result in zip(chunk, results):
+            if result is True:
+                exchange_manager.forget_calendar_item(item)
+            else:
+                failed_items.append(item)
+
+    for item in failed_items:
+        try_deleting_calendar_item(item, exchange_manager)
 
 
 def webcal_dict_to_wrapper(webcalendar_dict: list[dict]) -> list[EventWrapper]:
@@ -83,43 +227,34 @@ def webcal_dict_to_wrapper(webcalendar_dict: list[dict]) -> list[EventWrapper]:
 
 
 def webcal_to_wrapper(webcalendar) -> list[EventWrapper]:
-    all_events = [
-        subcomp for subcomp in webcalendar.subcomponents if subcomp.name == "VEVENT"
+    # skip submission dates and all events that are stemming from your own SAKAI calendar
+    # UID of event is either "MCI-DESIGNER-TERMIN-xxxx" or "MCI-SAKAI-TERMIN-xxxx"
+    return [
+        EventWrapper.from_ical_event(subcomp)
+        for subcomp in webcalendar.subcomponents
+        if subcomp.name == "VEVENT"
+        and "Abgabetermin" not in subcomp["summary"]
+        and "MCI-SAKAI-TERMIN" not in subcomp["uid"]
     ]
-    lecture_events = []
-    for event in all_events:
-        # skip submission dates
-        if "Abgabetermin" in event["summary"]:
-            continue
-
-        # skip all events that are stemming from your own SAKAI calendar
-        # UID of event is either "MCI-DESIGNER-TERMIN-xxxx" or "MCI-SAKAI-TERMIN-xxxx"
-        if "MCI-SAKAI-TERMIN" in event["uid"]:
-            continue
-
-        lecture_events.append(EventWrapper.from_ical_event(event))
 
-    return lecture_events
 
-
-def update_changed_events(wrapped_events: list[EventWrapper], exchange_manager):
+def update_changed_events(wrapped_events: list[EventWrapper], exchange_manager) -> int:
     calendar_items = exchange_manager.get_calendar_items(
         EventWrapper.get_default_organizer()
     )
 
-    logging.info(f"Found {len(calendar_items)} Exchange calendar items")
+    logging.info("Found %d Exchange calendar items", len(calendar_items))
     
     # Create dict with a composite key (subject, start time, duration) for better matching
-    calendar_item_dict = {}
+    # every item is wrapped only once and reused for the comparison and logging below
+    calendar_item_dict: dict[str, tuple[CalendarItem, EventWrapper]] = {}
     for item in calendar_items:
         if item.subject and item.start:
-            start_str = item.start.astimezone().strftime("%Y-%m-%d %H:%M")
-            end_time = item.end.astimezone() if item.end else None
-            duration = int((end_time - item.start.astimezone()).total_seconds() / 60) if end_time else 0
-            
+            wrapped = EventWrapper.from_outlook_event(item)
+
             # Create composite key: subject + start time + duration
-            key = f"{item.subject}|{start_str}|{duration}"
-            calendar_item_dict[key] = item
+            key = f"{wrapped.subject}|{wrapped.start}|{wrapped.duration}"
+            calendar_item_dict[key] = (item, wrapped)
 
     # create a dict of all found/imported events using the same composite key
     lecture_event_dict: dict[str, EventWrapper] = {}
@@ -129,57 +264,57 @@ def update_changed_events(wrapped_events: list[EventWrapper], exchange_manager):
             key = f"{event.subject}|{start_str}|{event.duration}"
             lecture_event_dict[key] = event
 
-    logging.info(f"Found {len(wrapped_events)} lecture ical events")
+    logging.info("Found %d lecture ical events", len(wrapped_events))
 
-    account = exchange_manager.get_account()
+    calendar_keys = set(calendar_item_dict)
+    lecture_keys = set(lecture_event_dict)
+
+    events_to_add = []
+    items_to_delete = []
 
+    # iterate the dicts and only use the sets for lookups, so the source order is kept
     for event_key, imported_event in lecture_event_dict.items():
-        # get corresponding calendar item from dict using composite key
-        corresponding_calendar_item = calendar_item_dict.get(event_key)
+        if event_key not in calendar_keys:
+            # if it is not available then add it
+            logging.info("\nAdding event:\n\t%s", imported_event)
+            events_to_add.append(imported_event)
+            continue
 
-        if corresponding_calendar_item:
-            # if found wrap it for comparison
-            calendar_item_wrapped = EventWrapper.from_outlook_event(
-                corresponding_calendar_item
-            )
+        calendar_item, calendar_item_wrapped = calendar_item_dict[event_key]
 
-            if imported_event != calendar_item_wrapped:
-                # event has changed --> delete and add again
-                logging.info(
-                    f"\nTrying to delete calendar item:\n\t{calendar_item_wrapped}"
-                )
-                if try_deleting_calendar_item(corresponding_calendar_item):
-                    # also remove from dict
-                    del calendar_item_dict[event_key]
+        if imported_event != calendar_item_wrapped:
+            # event has changed --> delete and add again
+            logging.info(
+                "\nTrying to delete calendar item:\n\t%s", calendar_item_wrapped
+            )
+            items_to_delete.append(calendar_item)
 
-                logging.info(f"\nAdding event:\n\t{imported_event}")
-                imported_event.to_outlook_event(account)
-            else:
-                logging.info(f"\nCalendar item is up to date:\n\t{imported_event}")
+            logging.info("\nAdding event:\n\t%s", imported_event)
+            events_to_add.append(imported_event)
         else:
-            # if it is not available then add it
-            logging.info(f"\nAdding event:\n\t{imported_event}")
-            imported_event.to_outlook_event(account)
-
-    # More calendar items than ical events --> something has been deleted in the ical events
-    if len(calendar_item_dict) > len(lecture_event_dict):
-        for calendar_item in calendar_item_dict.values():
-            calendar_item_wrapped = EventWrapper.from_outlook_event(calendar_item)
-
-            # if the calendar item is not in the ical events then delete it only if it is in the future
-            if (
-                calendar_item_wrapped.start_dt
-                and calendar_item_wrapped.start_dt
-                > datetime.datetime.now(
-                    calendar_item_wrapped.start_dt.tzinfo
-                    if calendar_item_wrapped.start_dt.tzinfo
-                    else None
-                )
-            ):
-                logging.info(
-                    f"\nTrying to delete calendar item:\n\t{calendar_item_wrapped}"
-                )
-                try_deleting_calendar_item(calendar_item)
+            logging.info("\nCalendar item is up to date:\n\t%s", imported_event)
+
+    for event_key, (calendar_item, calendar_item_wrapped) in calendar_item_dict.items():
+        if event_key in lecture_keys:
+            continue
+
+        # if the calendar item is not in the ical events then delete it only if it is in the future
+        if (
+            calendar_item_wrapped.start_dt
+            and calendar_item_wrapped.start_dt
+            > datetime.datetime.now(
+                calendar_item_wrapped.start_dt.tzinfo
+                if calendar_item_wrapped.start_dt.tzinfo
+                else None
+            )
+        ):
+            logging.info(
+                "\nTrying to delete calendar item:\n\t%s", calendar_item_wrapped
+            )
+            items_to_delete.append(calendar_item)
+
+    delete_calendar_items(items_to_delete, exchange_manager)
+    return save_events_to_outlook(events_to_add, exchange_manager)
 
 
 if __name__ == "__main__":
@@ -189,15 +324,18 @@ if __name__ == "__main__":
         Path(__file__).parent.resolve() / "full.log"
     )  # always logs into the same folder as the script, even when run from task scheduler
     logging.basicConfig(filename=logfile_path, encoding="utf-8", level=logging.DEBUG)
-    logging.info(f"Running at {datetime.datetime.now()}")
+    logging.info("Running at %s", datetime.datetime.now())
 
-    if config.use_ical_link() and config.use_api_call():
+    use_ical_link = config.use_ical_link()
+    use_api_call = config.use_api_call()
+
+    if use_ical_link and use_api_call:
         logging.error(
             "Both use_ical_link and use_api_call are set to True in config.py. Please choose only one method to fetch events."
         )
         exit(1)
 
-    if not (config.use_ical_link() or config.use_api_call()):
+    if not (use_ical_link or use_api_call):
         logging.error(
             "Both use_ical_link and use_api_call are set to False in config.py. Please choose one method to fetch events."
         )
@@ -205,22 +343,22 @@ if __name__ == "__main__":
 
     wrapped_events = []
 
-    if config.use_ical_link():
+    if use_ical_link:
         url = os.getenv("WEBCAL_URL")
         if url is None:
             logging.error("No webcal url found in .env file")
             exit(1)
 
         try:
-            response = requests.get(url)
+            webcal_body = fetch_webcal(url)
         except requests.exceptions.RequestException as e:
-            logging.error(f"Could not fetch calendar: {e}")
+            logging.error("Could not fetch calendar: %s", e)
             exit(1)
 
-        webcalendar = icalendar.Calendar.from_ical(response.text)
+        webcalendar = icalendar.Calendar.from_ical(webcal_body)
         wrapped_events = webcal_to_wrapper(webcalendar)
 
-    elif config.use_api_call():
+    elif use_api_call:
         user = os.getenv("USER")
         if user is None:
             logging.error("No user found in .env file")
@@ -231,11 +369,14 @@ if __name__ == "__main__":
 
     try:
         exchange_manager = ExchangeAccountManager()
-        update_changed_events(wrapped_events, exchange_manager)
+        failed_count = update_changed_events(wrapped_events, exchange_manager)
     except ValueError as e:
-        logging.error(f"Exchange configuration error: {e}")
+        logging.error("Exchange configuration error: %s", e)
         exit(1)
     except Exception as e:
-        logging.error(f"Error connecting to Exchange server: {e}")
+        logging.error("Error connecting to Exchange server: %s", e)
         exit(1)
 
+    if failed_count:
+        logging.error("Could not create %d calendar items", failed_count)
+        exit(1)